@@ -3,35 +3,62 @@ WhatsApp PDF Quadrant Combiner Bot (Flask + Twilio)
 
 Single-file app:
 - /webhook (POST) Twilio WhatsApp webhook
-- /download/<file_id> serves generated PDF from tempdir
+- /download/<file_id> serves generated PDF from an in-memory cache (unless staged on S3)
 - /health for readiness
-- In-memory sessions
-- Authenticated media download (prefers TWILIO_API_KEY + secret)
-- Twilio REST send with TwiML fallback
-- combine_pdfs_to_quadrant_pdf uses helper functions so you can place each quadrant independently
+- Sessions in memory (bounded, expired after SESSION_TTL seconds), or in Redis when
+  REDIS_URL is set so several workers can share them
+- Authenticated media download over a pooled keep-alive session (prefers TWILIO_API_KEY + secret)
+- Combine runs on a background pool; quick results go back as TwiML media, slow ones
+  are acked immediately and delivered later over the Twilio REST API
+- combine_pdfs embeds source pages as vectors, falling back to
+  combine_pdfs_to_quadrant_pdf (raster) for pages carrying oversized images
+
+Run in production with: gunicorn -c gunicorn_conf.py app:app
 
 Environment variables:
 - TWILIO_ACCOUNT_SID
 - TWILIO_AUTH_TOKEN (or TWILIO_API_KEY + TWILIO_API_SECRET)
 - TWILIO_WHATSAPP_FROM (e.g. "whatsapp:+1415...")
-- HOST_BASE_URL (public URL for /download links)
-- DPI (optional, default 300)
+- HOST_BASE_URL (public URL for /download links; optional when S3_BUCKET is set)
+- DPI (optional, default 300; upper bound on render resolution)
+- TARGET_OUTPUT_DPI (optional, default 300; print resolution of each quadrant)
+- JPEG_QUALITY (optional, default 85)
+- GENERATED_PDF_TTL (optional, seconds a combined PDF stays downloadable, default 600)
+- SESSION_TTL (optional, seconds an unfinished upload session is kept, default 1800)
+- REDIS_URL (optional, shared session/PDF store for multi-worker deployments)
+- MAX_PDF_MB (optional, largest PDF accepted per attachment, default 25)
+- INLINE_COMBINE_SECONDS (optional, how long the webhook waits to reply with the PDF inline, default 5)
+- S3_BUCKET (optional, stage combined PDFs on S3 and send presigned URLs; needs AWS credentials
+  and boto3, an optional extra not in requirements.txt; pair it with a bucket lifecycle rule
+  to delete old objects)
 """
 import os
+import math
+import functools
+import hashlib
+import time
 import tempfile
-import uuid
+import queue
+import shutil
 import logging
+import threading
+from io import BytesIO
 from pathlib import Path
-from flask import Flask, request, send_file, jsonify
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from flask import Flask, request, send_file
+import orjson
+import redis
+from cachetools import TTLCache
 from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
 from twilio.twiml.messaging_response import MessagingResponse
 from twilio.base.exceptions import TwilioRestException
 import requests
-from pdf2image import convert_from_bytes
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.units import mm
-from reportlab.lib.utils import ImageReader
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.util.retry import Retry
+import fitz  # PyMuPDF
+import pypdfium2 as pdfium
 from PIL import Image
 from dotenv import load_dotenv
 
@@ -50,103 +77,582 @@ TWILIO_API_SECRET = os.environ.get("TWILIO_API_SECRET")
 TWILIO_WHATSAPP_FROM = os.environ.get("TWILIO_WHATSAPP_FROM")
 HOST_BASE_URL = os.environ.get("HOST_BASE_URL")
 DPI = int(os.environ.get("DPI", "300"))
-
-if not (TWILIO_WHATSAPP_FROM and HOST_BASE_URL and TWILIO_ACCOUNT_SID):
-    raise RuntimeError("Set TWILIO_ACCOUNT_SID, TWILIO_WHATSAPP_FROM and HOST_BASE_URL in env")
-
-# Twilio client: prefer API key pair
+TARGET_OUTPUT_DPI = int(os.environ.get("TARGET_OUTPUT_DPI", "300"))
+JPEG_QUALITY = int(os.environ.get("JPEG_QUALITY", "85"))
+GENERATED_PDF_TTL = int(os.environ.get("GENERATED_PDF_TTL", "600"))
+SESSION_TTL = int(os.environ.get("SESSION_TTL", "1800"))
+REDIS_URL = os.environ.get("REDIS_URL")
+INLINE_COMBINE_SECONDS = float(os.environ.get("INLINE_COMBINE_SECONDS", "5"))
+S3_BUCKET = os.environ.get("S3_BUCKET")
+MAX_PDF_BYTES = int(float(os.environ.get("MAX_PDF_MB", "25")) * 1024 * 1024)
+
+if not (TWILIO_WHATSAPP_FROM and (HOST_BASE_URL or S3_BUCKET) and TWILIO_ACCOUNT_SID):
+    raise RuntimeError("Set TWILIO_ACCOUNT_SID, TWILIO_WHATSAPP_FROM and HOST_BASE_URL (or S3_BUCKET) in env")
+
+# Twilio client: prefer API key pair. One pooled HTTP client keeps the TLS
+# connection to api.twilio.com alive across messages.create calls.
+twilio_rest_http = TwilioHttpClient(pool_connections=True, timeout=10, max_retries=2)
 if TWILIO_API_KEY and TWILIO_API_SECRET and TWILIO_ACCOUNT_SID:
-    twilio_client = Client(TWILIO_API_KEY, TWILIO_API_SECRET, TWILIO_ACCOUNT_SID)
+    twilio_client = Client(TWILIO_API_KEY, TWILIO_API_SECRET, TWILIO_ACCOUNT_SID,
+                           http_client=twilio_rest_http)
     logger.info("Using Twilio API Key auth")
 else:
-    twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+    twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, http_client=twilio_rest_http)
     logger.info("Using Twilio Account SID + Auth Token auth")
 
-app = Flask(__name__)
+def warm_twilio_connection():
+    # A cheap authenticated GET leaves a keep-alive TLS connection in the pool,
+    # so the first user-facing send skips the handshake
+    try:
+        twilio_client.api.accounts(TWILIO_ACCOUNT_SID).fetch()
+        logger.info("Twilio connection warmed")
+    except Exception as e:
+        logger.warning("Twilio warm-up failed: %s", e)
+
+# Pooled keep-alive session for Twilio media downloads; credentials are fixed at boot
+twilio_http = requests.Session()
+twilio_http.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32,
+                                          max_retries=Retry(total=2, backoff_factor=0.2,
+                                                            status_forcelist=[502, 503, 504])))
+_media_auth_user = TWILIO_API_KEY or TWILIO_ACCOUNT_SID
+_media_auth_pass = TWILIO_API_SECRET or TWILIO_AUTH_TOKEN
+if _media_auth_user and _media_auth_pass:
+    twilio_http.auth = (_media_auth_user, _media_auth_pass)
 
-# In-memory sessions
-user_sessions = {}
+app = Flask(__name__)
+# Combined PDFs are immutable per file_id; let Twilio/clients cache them briefly
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 300
+
+def cleanup_session_files(sess):
+    # All uploads of a session live in its own scratch dir
+    if sess.get("dir"):
+        shutil.rmtree(sess["dir"], ignore_errors=True)
+
+class SessionCache(TTLCache):
+    """TTLCache that deletes a session's uploads when it expires or is evicted."""
+
+    def popitem(self):
+        key, sess = super().popitem()
+        cleanup_session_files(sess)
+        return key, sess
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        for _, sess in expired:
+            cleanup_session_files(sess)
+        return expired
+
+# Caps on worst-case memory and scratch disk: sessions kept, and uploads per session
+# (a combine uses exactly two PDFs, so nothing past those is worth keeping)
+MAX_SESSIONS = 10000
+MAX_SESSION_FILES = 2
+
+# In-memory sessions, shared with the background combine workers
+user_sessions = SessionCache(maxsize=MAX_SESSIONS, ttl=SESSION_TTL)
+sessions_lock = threading.Lock()
+
+# Shared store for sessions and generated PDFs when running several workers.
+# Uploads stay in local scratch dirs, so workers must share one host's /tmp.
+# Bounded pool so a stalled Redis times out webhook threads instead of hanging them
+redis_pool = (redis.BlockingConnectionPool.from_url(REDIS_URL, max_connections=32, timeout=5,
+                                                    socket_timeout=5, socket_connect_timeout=5)
+              if REDIS_URL else None)
+redis_client = redis.Redis(connection_pool=redis_pool) if redis_pool is not None else None
+if redis_client is not None:
+    logger.info("Using Redis session store")
+
+# --- Session store ---
+def new_session():
+    return {"files": [], "state": "collecting"}
+
+def session_key(from_number: str) -> str:
+    return f"sess:{from_number}"
+
+def snapshot_session(sess: dict) -> dict:
+    return dict(sess, files=list(sess["files"]))
+
+def get_session(from_number: str) -> dict:
+    """Copy of the sender's session (a fresh, unsaved one if none exists)."""
+    if redis_client is not None:
+        raw = redis_client.get(session_key(from_number))
+        return orjson.loads(raw) if raw else new_session()
+    with sessions_lock:
+        sess = user_sessions.get(from_number)
+        return snapshot_session(sess) if sess else new_session()
+
+def update_session(from_number: str, mutate) -> dict:
+    """Atomically apply mutate(sess), save it with a fresh TTL and return a copy."""
+    if redis_client is not None:
+        key = session_key(from_number)
+
+        def txn(pipe):
+            raw = pipe.get(key)
+            sess = orjson.loads(raw) if raw else new_session()
+            mutate(sess)
+            pipe.multi()
+            pipe.setex(key, SESSION_TTL, orjson.dumps(sess))
+            return sess
+
+        # WATCH/MULTI retries txn if another worker changed the session meanwhile
+        return redis_client.transaction(txn, key, value_from_callable=True)
+    with sessions_lock:
+        sess = user_sessions.get(from_number) or new_session()
+        mutate(sess)
+        user_sessions[from_number] = sess
+        return snapshot_session(sess)
+
+def pop_session(from_number: str):
+    """Remove and return the sender's session, or None if another request took it."""
+    if redis_client is not None:
+        pipe = redis_client.pipeline()
+        pipe.get(session_key(from_number))
+        pipe.delete(session_key(from_number))
+        raw, _ = pipe.execute()
+        return orjson.loads(raw) if raw else None
+    with sessions_lock:
+        return user_sessions.pop(from_number, None)
+
+# Combined PDFs awaiting download: file_id -> (expires_at, pdf_bytes)
+generated_pdfs = {}
+
+# Shared pool for per-page JPEG encoding (PIL releases the GIL while encoding)
+encode_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="encode")
+
+# Extra attachments in a multi-media message; the first one downloads on the request thread
+download_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="download")
+
+# Background combine+send jobs so the webhook can answer Twilio right away
+combine_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="combine")
+
+# PDFium is not thread-safe, even across documents; rendering is serialized
+pdfium_lock = threading.Lock()
+
+# PyMuPDF is not thread-safe either; vector combines are serialized
+mupdf_lock = threading.Lock()
+
+# Recycled output buffers for combine_pdfs_to_quadrant_pdf
+out_buffer_pool = queue.LifoQueue(maxsize=os.cpu_count() or 4)
+
+# Reply words understood while a combine is awaiting confirmation
+COMMANDS = {"yes": "confirm", "y": "confirm", "no": "cancel", "n": "cancel"}
+
+# Bump whenever combine output changes for the same inputs (layout, render or embed logic);
+# it salts the dedupe key, so outputs cached on S3/Redis by an older release are not reused
+COMBINE_VERSION = 1
+
+# Quadrant layout on the A4 output page (top-left corners in mm from the page top)
+QUAD_W_MM = 99.1
+QUAD_H_MM = 139.0
+POSITIONS_MM = (
+    (7.0, 10.0),    # A (top-left)
+    (102.0, 14.0),  # B (top-right)
+    (7.0, 152.0),   # C (bottom-left)
+    (102.0, 152.0), # D (bottom-right)
+)
+ZOOM_FACTORS = (1.0, 1.1, 1.0, 1.1)  # B and D zoomed
 
 # Geometry helpers
+MM_TO_PT = 72.0 / 25.4
+
 def mm_to_pt(value_mm):
-    return value_mm * mm
+    return value_mm * MM_TO_PT
+
+# Layout in points, computed once (A4 is 210 x 297 mm)
+PAGE_W_PT, PAGE_H_PT = mm_to_pt(210.0), mm_to_pt(297.0)
+QUAD_W_PT = mm_to_pt(QUAD_W_MM)
+QUAD_H_PT = mm_to_pt(QUAD_H_MM)
+POSITIONS_PT = tuple((mm_to_pt(x_mm), mm_to_pt(y_mm)) for x_mm, y_mm in POSITIONS_MM)
+# Zoomed quadrant boxes (top-down page coordinates) for the vector combine; read-only
+QUAD_RECTS = tuple(fitz.Rect(x_pt, top_pt, x_pt + QUAD_W_PT * zoom, top_pt + QUAD_H_PT * zoom)
+                   for (x_pt, top_pt), zoom in zip(POSITIONS_PT, ZOOM_FACTORS))
+
+def needed_render_dpi(page_w_pt: float, page_h_pt: float, zoom: float = 1.0,
+                      target_dpi: int = TARGET_OUTPUT_DPI) -> int:
+    """DPI at which a source page fills its quadrant at exactly target_dpi."""
+    fit = min(QUAD_W_PT * zoom / page_w_pt, QUAD_H_PT * zoom / page_h_pt)
+    return max(1, math.ceil(target_dpi * fit))
+
+@functools.lru_cache(maxsize=8)
+def quadrant_target_px(zoom: float = 1.0):
+    """Pixel size of a (zoomed) quadrant printed at TARGET_OUTPUT_DPI."""
+    return (int(QUAD_W_MM * zoom / 25.4 * TARGET_OUTPUT_DPI),
+            int(QUAD_H_MM * zoom / 25.4 * TARGET_OUTPUT_DPI))
 
 # --- Image rendering & placement helpers ---
 
-def render_page_images(pdf_bytes: bytes, dpi: int = DPI):
-    imgs = convert_from_bytes(pdf_bytes, dpi=dpi, first_page=1, last_page=2)
-    if len(imgs) < 2:
-        raise ValueError("Each PDF must have at least 2 pages")
-    return imgs
+def render_page_images(pdf_source, dpi: int = DPI, zooms=(1.0, 1.0), skip=(False, False)):
+    # pdf_source is a file path or bytes; PDFium reads paths itself, so no Python-side copy
+    with pdfium_lock:
+        pdf = pdfium.PdfDocument(pdf_source)
+        try:
+            if len(pdf) < 2:
+                raise ValueError("Each PDF must have at least 2 pages")
+            imgs = []
+            for page_index in range(2):
+                if skip[page_index]:
+                    imgs.append(None)
+                    continue
+                page = pdf[page_index]
+                try:
+                    # Never render more pixels than the quadrant can print; DPI is only a cap
+                    page_w_pt, page_h_pt = page.get_size()
+                    render_dpi = min(dpi, needed_render_dpi(page_w_pt, page_h_pt, zooms[page_index]))
+                    # RGBX in PIL byte order lets to_pil() wrap the bitmap buffer instead of copying it
+                    bitmap = page.render(scale=render_dpi / 72.0, rev_byteorder=True, prefer_bgrx=True)
+                    imgs.append(bitmap.to_pil())
+                    # Free the PDFium handle under the lock; the image keeps the Python-owned buffer
+                    bitmap.close()
+                finally:
+                    page.close()
+            return imgs
+        finally:
+            pdf.close()
+
+def encode_page(pil_img: Image.Image, zoom: float = 1.0) -> bytes:
+    # Never embed more pixels than the quadrant prints at TARGET_OUTPUT_DPI
+    target_w_px, target_h_px = quadrant_target_px(zoom)
+    if pil_img.width > target_w_px or pil_img.height > target_h_px:
+        pil_img.thumbnail((target_w_px, target_h_px), Image.Resampling.LANCZOS)
+    # JPEG has no alpha channel; RGBX is written as RGB directly, so this rarely copies
+    if pil_img.mode not in ("RGB", "RGBX"):
+        pil_img = pil_img.convert("RGB")
+    buf = BytesIO()
+    pil_img.save(buf, format="JPEG", quality=JPEG_QUALITY, optimize=False, progressive=False)
+    return buf.getvalue()
 
-def place_image_on_canvas(cnv: canvas.Canvas, pil_img: Image.Image,
+def place_image_on_canvas(cnv, image_bytes: bytes,
                           quadrant_index: int,
                           zoom: float = 1.0,
                           anchor_top_left: bool = True):
-    quad_w_mm = 99.1
-    quad_h_mm = 139.0
-    positions_mm = [
-        (7.0, 10.0),    # A (top-left)
-        (102.0, 14.0),  # B (top-right)
-        (7.0, 152.0),   # C (bottom-left)
-        (102.0, 152.0), # D (bottom-right)
-    ]
+    from reportlab.lib.utils import ImageReader
+
     if quadrant_index < 0 or quadrant_index > 3:
         raise ValueError("quadrant_index must be 0..3")
 
-    x_mm, y_mm = positions_mm[quadrant_index]
-    base_w_pt = mm_to_pt(quad_w_mm)
-    base_h_pt = mm_to_pt(quad_h_mm)
-    target_w_pt = base_w_pt * zoom
-    target_h_pt = base_h_pt * zoom
-
-    page_w_pt, page_h_pt = A4
+    x_pt, top_pt = POSITIONS_PT[quadrant_index]
+    target_w_pt = QUAD_W_PT * zoom
+    target_h_pt = QUAD_H_PT * zoom
 
     if not anchor_top_left:
-        center_x_mm = x_mm + (quad_w_mm / 2.0)
-        center_y_mm = y_mm + (quad_h_mm / 2.0)
-        center_x_pt = mm_to_pt(center_x_mm)
-        x_pt = center_x_pt - (target_w_pt / 2.0)
-        y_pt = page_h_pt - mm_to_pt(center_y_mm) - (target_h_pt / 2.0)
+        x_pt = x_pt + (QUAD_W_PT / 2.0) - (target_w_pt / 2.0)
+        y_pt = PAGE_H_PT - (top_pt + QUAD_H_PT / 2.0) - (target_h_pt / 2.0)
     else:
-        x_pt = mm_to_pt(x_mm)
-        y_pt = page_h_pt - mm_to_pt(y_mm) - target_h_pt
-
-    if pil_img.mode not in ("RGB", "RGBA"):
-        pil_img = pil_img.convert("RGB")
-
-    from io import BytesIO
-    buf = BytesIO()
-    pil_img.save(buf, format="PNG")
-    buf.seek(0)
-    img_reader = ImageReader(buf)
+        y_pt = PAGE_H_PT - top_pt - target_h_pt
 
-    cnv.drawImage(img_reader, x_pt, y_pt,
+    cnv.drawImage(ImageReader(BytesIO(image_bytes)), x_pt, y_pt,
                   width=target_w_pt, height=target_h_pt,
                   preserveAspectRatio=True, anchor='sw')
-    buf.close()
 
-def combine_pdfs_to_quadrant_pdf(pdf_bytes1: bytes, pdf_bytes2: bytes, dpi: int = DPI) -> bytes:
-    imgs1 = render_page_images(pdf_bytes1, dpi=dpi)
-    imgs2 = render_page_images(pdf_bytes2, dpi=dpi)
+def acquire_out_buffer() -> BytesIO:
+    try:
+        return out_buffer_pool.get_nowait()
+    except queue.Empty:
+        return BytesIO()
+
+def release_out_buffer(buf: BytesIO):
+    buf.seek(0)
+    buf.truncate()
+    try:
+        out_buffer_pool.put_nowait(buf)
+    except queue.Full:
+        pass
+
+def scanned_page_jpeg(page, zoom: float = 1.0):
+    """Raw JPEG of a page that is just one upright full-page scan, or None."""
+    images = page.get_images(full=True)
+    if len(images) != 1 or page.rotation or page.get_text().strip():
+        return None
+    xref, smask, width, height, _, _, _, _, img_filter = images[0][:9]
+    target_w_px, target_h_px = quadrant_target_px(zoom)
+    if img_filter != "DCTDecode" or smask or width > target_w_px or height > target_h_px:
+        return None
+    rects = page.get_image_rects(xref, transform=True)
+    if len(rects) != 1:
+        return None
+    rect, matrix = rects[0]
+    if matrix.b or matrix.c or matrix.a <= 0 or matrix.d <= 0:
+        return None
+    if rect.get_area() < 0.95 * page.rect.get_area():
+        return None
+    data = page.parent.xref_stream_raw(xref)
+    return data if data[:2] == b"\xff\xd8" else None
+
+def scanned_page_jpegs(pdf_source, zooms=(1.0, 1.0)):
+    with mupdf_lock:
+        doc = open_fitz_document(pdf_source)
+        try:
+            if doc.page_count < 2:
+                return [None, None]
+            return [scanned_page_jpeg(doc[i], zooms[i]) for i in range(2)]
+        finally:
+            doc.close()
+
+def combine_pdfs_to_quadrant_pdf(pdf_source1, pdf_source2, dpi: int = DPI) -> bytes:
+    # Pages that are a single scanned JPEG are embedded as-is, skipping render + re-encode
+    jpegs = (scanned_page_jpegs(pdf_source1, ZOOM_FACTORS[0:2])
+             + scanned_page_jpegs(pdf_source2, ZOOM_FACTORS[2:4]))
+    skip = [jpeg is not None for jpeg in jpegs]
+    imgs1 = render_page_images(pdf_source1, dpi=dpi, zooms=ZOOM_FACTORS[0:2], skip=skip[0:2])
+    imgs2 = render_page_images(pdf_source2, dpi=dpi, zooms=ZOOM_FACTORS[2:4], skip=skip[2:4])
     pages = [imgs1[0], imgs1[1], imgs2[0], imgs2[1]]  # A,B,C,D
 
-    zoom_factors = [1.0, 1.1, 1.0, 1.1]  # B and D zoomed
+    # Encode in parallel; the ReportLab canvas is not thread-safe so drawing stays serial
+    to_encode = [idx for idx, pil_img in enumerate(pages) if pil_img is not None]
+    encoded = list(jpegs)
+    for idx, image_bytes in zip(to_encode, encode_pool.map(
+            encode_page, [pages[i] for i in to_encode], [ZOOM_FACTORS[i] for i in to_encode])):
+        encoded[idx] = image_bytes
+    # Drop the raw bitmaps (several MB each) before ReportLab builds the page
+    pages = imgs1 = imgs2 = None
+
+    # ReportLab is only needed on this fallback path, so it stays off the cold-start import
+    from reportlab import rl_config
+    from reportlab.pdfgen import canvas
+    # Embed binary streams as-is; ReportLab's default ASCII85 wrapping inflates them by 25%
+    rl_config.useA85 = 0
+
+    out_io = acquire_out_buffer()
+    try:
+        # JPEG streams pass through untouched; this deflates content streams and metadata
+        cnv = canvas.Canvas(out_io, pagesize=(PAGE_W_PT, PAGE_H_PT), pageCompression=1)
+
+        for idx, image_bytes in enumerate(encoded):
+            place_image_on_canvas(cnv, image_bytes, quadrant_index=idx,
+                                  zoom=ZOOM_FACTORS[idx],
+                                  anchor_top_left=True)
+
+        cnv.showPage()
+        cnv.save()
+        return out_io.getvalue()
+    finally:
+        release_out_buffer(out_io)
+
+# --- Vector combine (no rasterization) ---
+def open_fitz_document(pdf_source):
+    if isinstance(pdf_source, (bytes, bytearray)):
+        return fitz.open(stream=pdf_source, filetype="pdf")
+    return fitz.open(pdf_source)
+
+def has_oversized_raster(page, zoom: float = 1.0) -> bool:
+    # Pages carrying images bigger than the quadrant can print go through the raster
+    # path instead, which downsamples them; vector embedding would copy them whole
+    target_w_px, target_h_px = quadrant_target_px(zoom)
+    return any(img[2] * img[3] > target_w_px * target_h_px for img in page.get_images(full=True))
+
+def combine_pdfs_vector(pdf_source1, pdf_source2):
+    """Embed the four source pages as vector XObjects; None if raster fallback is needed."""
+    with mupdf_lock:
+        docs = [open_fitz_document(pdf_source1), open_fitz_document(pdf_source2)]
+        out_doc = fitz.open()
+        try:
+            if any(doc.page_count < 2 for doc in docs):
+                raise ValueError("Each PDF must have at least 2 pages")
+            out_page = out_doc.new_page(width=PAGE_W_PT, height=PAGE_H_PT)
+            # One pass, one source page loaded at a time; bail out to raster on the first
+            # oversized image (the partly built out_doc is simply discarded)
+            for idx in range(4):
+                src_doc, src_pno = docs[idx // 2], idx % 2
+                src_page = src_doc[src_pno]
+                if has_oversized_raster(src_page, ZOOM_FACTORS[idx]):
+                    return None
+                src_rect = src_page.rect
+                src_page = None
+                box = QUAD_RECTS[idx]
+                # Fit and anchor bottom-left, matching drawImage(anchor='sw') on the raster path
+                fit = min(box.width / src_rect.width, box.height / src_rect.height)
+                draw_rect = fitz.Rect(box.x0, box.y1 - src_rect.height * fit,
+                                      box.x0 + src_rect.width * fit, box.y1)
+                out_page.show_pdf_page(draw_rect, src_doc, src_pno, keep_proportion=True)
+            return out_doc.tobytes(garbage=4, clean=True, deflate=True,
+                                   deflate_images=True, deflate_fonts=True)
+        finally:
+            out_doc.close()
+            for doc in docs:
+                doc.close()
+
+def combine_pdfs(pdf_source1, pdf_source2, dpi: int = DPI) -> bytes:
+    pdf_bytes = combine_pdfs_vector(pdf_source1, pdf_source2)
+    if pdf_bytes is None:
+        pdf_bytes = combine_pdfs_to_quadrant_pdf(pdf_source1, pdf_source2, dpi=dpi)
+    return pdf_bytes
+
+# --- Generated PDF cache ---
+def store_generated_pdf(file_id: str, pdf_bytes: bytes):
+    if redis_client is not None:
+        redis_client.setex(f"pdf:{file_id}", GENERATED_PDF_TTL, pdf_bytes)
+        return
+    generated_pdfs[file_id] = (time.monotonic() + GENERATED_PDF_TTL, pdf_bytes)
+
+def get_generated_pdf(file_id: str):
+    if redis_client is not None:
+        return redis_client.get(f"pdf:{file_id}")
+    entry = generated_pdfs.get(file_id)
+    if entry is None or entry[0] <= time.monotonic():
+        return None
+    return entry[1]
+
+# Twilio fetches staged PDFs straight from S3, keeping this process off the download path
+if S3_BUCKET:
+    import boto3  # optional, only needed with S3_BUCKET
+    from botocore.exceptions import ClientError
+    s3_client = boto3.client("s3")
+    logger.info("Staging combined PDFs on S3 bucket %s", S3_BUCKET)
+else:
+    s3_client = None
+
+def s3_presigned_url(key: str) -> str:
+    return s3_client.generate_presigned_url("get_object", Params={"Bucket": S3_BUCKET, "Key": key},
+                                            ExpiresIn=GENERATED_PDF_TTL)
+
+# Everything besides the inputs that shapes a combined PDF
+COMBINE_SALT = repr((COMBINE_VERSION, QUAD_W_MM, QUAD_H_MM, POSITIONS_MM, ZOOM_FACTORS,
+                     DPI, TARGET_OUTPUT_DPI, JPEG_QUALITY)).encode()
+
+def inputs_digest(paths) -> str:
+    """Content hash of the source PDFs (in order) plus the layout and output settings."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(COMBINE_SALT)
+    for path in paths:
+        with open(path, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                h.update(chunk)
+        # Mark where each file ends so (ab, c) and (a, bc) never hash alike
+        h.update(os.path.getsize(path).to_bytes(8, "big"))
+    return h.hexdigest()
+
+def find_generated_pdf(file_id: str):
+    """URL of a PDF already combined under file_id, with its lifetime renewed; None if gone."""
+    if s3_client is not None:
+        key = f"combined/{file_id}.pdf"
+        try:
+            # Copying the object onto itself resets LastModified, so the bucket's lifecycle
+            # rule cannot delete it while the fresh presigned URL is still in use
+            s3_client.copy_object(Bucket=S3_BUCKET, Key=key,
+                                  CopySource={"Bucket": S3_BUCKET, "Key": key},
+                                  MetadataDirective="REPLACE", ContentType="application/pdf",
+                                  ContentDisposition=f'attachment; filename="combined_{file_id}.pdf"')
+            return s3_presigned_url(key)
+        except ClientError as e:
+            # Not staged on S3 (it may have gone to the local fallback store) is a plain miss
+            if e.response.get("Error", {}).get("Code") not in ("404", "NoSuchKey", "NotFound"):
+                logger.warning("S3 reuse check failed for %s: %s", key, e)
+        except Exception as e:
+            logger.warning("S3 reuse check failed for %s: %s", key, e)
+    if redis_client is not None:
+        found = redis_client.expire(f"pdf:{file_id}", GENERATED_PDF_TTL)
+    else:
+        pdf_bytes = get_generated_pdf(file_id)
+        found = pdf_bytes is not None
+        if found:
+            store_generated_pdf(file_id, pdf_bytes)
+    return f"{HOST_BASE_URL}/download/{file_id}" if found else None
+
+def publish_generated_pdf(file_id: str, pdf_bytes: bytes) -> str:
+    """Store a combined PDF and return the URL Twilio should fetch it from."""
+    if s3_client is not None:
+        key = f"combined/{file_id}.pdf"
+        try:
+            s3_client.put_object(Bucket=S3_BUCKET, Key=key, Body=pdf_bytes,
+                                 ContentType="application/pdf",
+                                 ContentDisposition=f'attachment; filename="combined_{file_id}.pdf"')
+            return s3_presigned_url(key)
+        except Exception as e:
+            if not HOST_BASE_URL:
+                raise
+            logger.warning("S3 upload failed, serving from /download instead: %s", e)
+    store_generated_pdf(file_id, pdf_bytes)
+    return f"{HOST_BASE_URL}/download/{file_id}"
+
+# --- Background janitor ---
+JANITOR_INTERVAL = 60
+# Slack past SESSION_TTL so a combine started just before expiry keeps its inputs
+SCRATCH_DIR_GRACE = 600
+
+def sweep_expired():
+    now = time.monotonic()
+    for fid, (expires_at, _) in list(generated_pdfs.items()):
+        if expires_at <= now:
+            generated_pdfs.pop(fid, None)
+    with sessions_lock:
+        user_sessions.expire()
+    # Catches dirs whose session expired in Redis or died with a worker
+    cutoff = time.time() - SESSION_TTL - SCRATCH_DIR_GRACE
+    for path in Path(tempfile.gettempdir()).glob("esbot_*"):
+        try:
+            if path.is_dir() and path.stat().st_mtime < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
+
+def janitor():
+    while True:
+        time.sleep(JANITOR_INTERVAL)
+        try:
+            sweep_expired()
+        except Exception as e:
+            logger.exception("Janitor sweep failed: %s", e)
 
-    out_io = tempfile.SpooledTemporaryFile()
-    cnv = canvas.Canvas(out_io, pagesize=A4)
+def start_background_threads():
+    """Start per-process background work; called at server startup, never on import."""
+    # Off the request path so a slow or unreachable Twilio never delays worker boot
+    threading.Thread(target=warm_twilio_connection, name="twilio-warmup", daemon=True).start()
+    threading.Thread(target=janitor, name="janitor", daemon=True).start()
 
-    for idx, pil_img in enumerate(pages):
-        place_image_on_canvas(cnv, pil_img, quadrant_index=idx,
-                              zoom=zoom_factors[idx],
-                              anchor_top_left=True)
+# --- Media download helper ---
+class MediaTooLargeError(ValueError):
+    pass
 
-    cnv.showPage()
-    cnv.save()
-    out_io.seek(0)
-    result = out_io.read()
-    out_io.close()
-    return result
+def read_media_chunk(raw, size: int) -> bytes:
+    # r.raw skips requests' error wrapping; map dropped or stalled bodies back onto it
+    try:
+        return raw.read(size)
+    except urllib3.exceptions.HTTPError as e:
+        raise requests.ConnectionError(e) from e
+
+def download_media_to_tempfile(m_url: str, dir_path: str):
+    """Stream a Twilio media URL to a temp file in dir_path; returns its path, or None on a bad
+    response. Raises ValueError if the body is not a PDF, MediaTooLargeError past MAX_PDF_BYTES."""
+    # PDFs barely compress; asking for identity encoding lets the raw socket bytes go straight to disk
+    # Fail fast on connect; allow longer gaps between chunks of a large PDF
+    with twilio_http.get(m_url, timeout=(5, 30), allow_redirects=True, stream=True,
+                         headers={"Accept-Encoding": "identity"}) as r:
+        if r.status_code != 200:
+            return None
+        # Reject empty/stub bodies before touching disk when the length is advertised
+        content_length = r.headers.get("Content-Length")
+        if content_length is not None and content_length.isdigit():
+            if int(content_length) <= 10:
+                return None
+            # The GET's headers arrive before the body, so oversized media costs no bandwidth
+            if int(content_length) > MAX_PDF_BYTES:
+                raise MediaTooLargeError(f"Media is {content_length} bytes")
+        # Error pages and truncated bodies are rejected before anything hits disk;
+        # readers accept up to 1 KiB of junk ahead of the %PDF- header
+        r.raw.decode_content = False
+        head = read_media_chunk(r.raw, 1024)
+        if b"%PDF-" not in head:
+            raise ValueError("Downloaded media is not a PDF")
+        tmpf = tempfile.NamedTemporaryFile(dir=dir_path, delete=False, suffix=".pdf")
+        try:
+            with tmpf:
+                tmpf.write(head)
+                # Bounded copy: chunked responses carry no Content-Length to check up front
+                remaining = MAX_PDF_BYTES - len(head)
+                while chunk := read_media_chunk(r.raw, 64 * 1024):
+                    remaining -= len(chunk)
+                    if remaining < 0:
+                        raise MediaTooLargeError("Media exceeds MAX_PDF_BYTES")
+                    tmpf.write(chunk)
+                tmpf.flush()
+                os.fsync(tmpf.fileno())
+                size = tmpf.tell()
+        except Exception:
+            Path(tmpf.name).unlink(missing_ok=True)
+            raise
+    if size <= 10:
+        Path(tmpf.name).unlink(missing_ok=True)
+        return None
+    return tmpf.name
 
 # --- Twilio helper ---
 def send_whatsapp_message(to_whatsapp_number, body, media_url=None):
@@ -166,10 +672,36 @@ def send_whatsapp_message(to_whatsapp_number, body, media_url=None):
         logger.exception("Unexpected Twilio send error: %s", e)
         return False
 
+# --- Background combine job ---
+def combine_session(sess: dict) -> str:
+    """Combine the session's two PDFs and return the download URL."""
+    try:
+        paths = [f["path"] for f in sess["files"][:2]]
+        # Outputs are keyed by their inputs, so resending the same two PDFs skips the combine
+        file_id = inputs_digest(paths)
+        file_url = find_generated_pdf(file_id)
+        if file_url is not None:
+            logger.info("Reusing combined PDF %s", file_id)
+            return file_url
+        return publish_generated_pdf(file_id, combine_pdfs(paths[0], paths[1], dpi=DPI))
+    finally:
+        cleanup_session_files(sess)
+
+def send_combined_result(from_number: str, future):
+    # Only used when the combine outlives the webhook; delivers over the REST API
+    try:
+        file_url = future.result()
+    except Exception as e:
+        logger.exception("Combine failed: %s", e)
+        send_whatsapp_message(from_number, f"Failed to combine PDFs: {e}")
+        return
+    if not send_whatsapp_message(from_number, "Here is your combined PDF:", media_url=file_url):
+        send_whatsapp_message(from_number, f"Here is your combined PDF (link): {file_url}")
+
 # --- Routes ---
 @app.route("/", methods=["GET"])
 def root():
-    return jsonify({
+    return app.response_class(orjson.dumps({
         "service": "pdf-whatsapp-quadrant-combiner",
         "status": "ok",
         "endpoints": {
@@ -177,7 +709,7 @@ def root():
             "download": "/download/<file_id> (GET)",
             "health": "/health (GET)"
         }
-    }), 200
+    }), status=200, mimetype="application/json")
 
 @app.route("/health", methods=["GET"])
 def health():
@@ -185,109 +717,139 @@ def health():
 
 @app.route("/download/<file_id>", methods=["GET"])
 def download_generated(file_id):
-    tmpdir = Path(tempfile.gettempdir())
-    fp = tmpdir / f"combined_{file_id}.pdf"
-    if not fp.exists():
+    pdf_bytes = get_generated_pdf(file_id)
+    if pdf_bytes is None:
         return "Not found", 404
-    return send_file(str(fp), as_attachment=True,
-                     download_name=f"combined_{file_id}.pdf")
+    # Content never changes for a file_id, so it doubles as the ETag for 304/range requests
+    return send_file(BytesIO(pdf_bytes), mimetype="application/pdf", as_attachment=True,
+                     download_name=f"combined_{file_id}.pdf",
+                     conditional=True, etag=file_id)
 
 @app.route("/webhook", methods=["POST"])
 def webhook():
-    logger.info("Incoming webhook: %s", dict(request.values))
-    from_number = request.values.get("From")
-    body = (request.values.get("Body") or "").strip()
-    body_lower = body.lower()
-    num_media = int(request.values.get("NumMedia", "0"))
+    # Flatten the combined form/args MultiDict once; every lookup below is a plain dict get
+    form = request.values.to_dict(flat=True)
+    logger.info("Incoming webhook: %s", form)
+    from_number = form.get("From")
+    body = (form.get("Body") or "").strip()
+    command = COMMANDS.get(body.lower())
+    num_media = int(form.get("NumMedia", "0"))
 
     if not from_number:
         resp = MessagingResponse()
         resp.message("Missing From number in request.")
         return str(resp)
 
-    sess = user_sessions.setdefault(from_number, {"files": [], "state": "collecting"})
+    sess = get_session(from_number)
     resp = MessagingResponse()
 
     if num_media > 0:
-        for i in range(num_media):
-            m_url = request.values.get(f"MediaUrl{i}")
-            m_type = request.values.get(f"MediaContentType{i}", "")
+        if len(sess["files"]) >= MAX_SESSION_FILES:
+            resp.message("You already sent two PDFs. Reply YES to combine them, or NO to cancel.")
+            return str(resp)
+        g = form.get
+        media = [(g(f"MediaUrl{i}"), g(f"MediaContentType{i}", "")) for i in range(num_media)]
+        for i, (m_url, m_type) in enumerate(media):
             logger.info("Media %s type=%s url=%s", i, m_type, m_url)
 
-            if "pdf" in m_type.lower():
-                auth_user = TWILIO_API_KEY or TWILIO_ACCOUNT_SID
-                auth_pass = TWILIO_API_SECRET or TWILIO_AUTH_TOKEN
-                try:
-                    if auth_user and auth_pass:
-                        r = requests.get(m_url, auth=(auth_user, auth_pass), timeout=30)
-                    else:
-                        r = requests.get(m_url, timeout=30)
-                    if r.status_code == 200 and r.content and len(r.content) > 10:
-                        tmpf = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
-                        tmpf.write(r.content)
-                        tmpf.flush()
-                        tmpf.close()
-                        sess["files"].append({"path": tmpf.name,
-                                              "orig_name": f"file_{len(sess['files'])+1}.pdf"})
-                        resp.message(f"Received PDF #{len(sess['files'])}.")
-                    else:
-                        resp.message("Failed to download attached file. Please try again.")
-                        return str(resp)
-                except requests.RequestException as ex:
-                    logger.exception("Exception downloading media: %s", ex)
-                    resp.message("Network error when downloading file. Please try again.")
-                    return str(resp)
-            else:
-                resp.message("Please send PDF files only.")
+        # WhatsApp sends one media per message, so the first PDF downloads right here and
+        # only extra attachments go to the shared pool; the rest are handled in message order.
+        # PDFs beyond the session's remaining slots are never downloaded
+        pdf_indexes = [i for i, (_, m_type) in enumerate(media) if "pdf" in m_type.lower()]
+        fetch = pdf_indexes[:MAX_SESSION_FILES - len(sess["files"])]
+        # No scratch dir or saved session for messages with nothing to download
+        if fetch and not sess.get("dir"):
+            # Another webhook from this sender may have created one meanwhile; keep theirs
+            new_dir = tempfile.mkdtemp(prefix="esbot_")
+            sess = update_session(from_number, lambda s: s.setdefault("dir", new_dir))
+            if sess["dir"] != new_dir:
+                shutil.rmtree(new_dir, ignore_errors=True)
+        downloads = {i: download_pool.submit(download_media_to_tempfile, media[i][0], sess["dir"])
+                     for i in fetch[1:]}
+        for i in range(len(media)):
+            if i not in fetch:
+                if i in pdf_indexes:
+                    resp.message("Only two PDFs can be combined; this extra one was ignored.")
+                else:
+                    resp.message("Please send PDF files only.")
+                continue
+            try:
+                if i in downloads:
+                    tmp_path = downloads[i].result()
+                else:
+                    tmp_path = download_media_to_tempfile(media[i][0], sess["dir"])
+            except requests.RequestException as ex:
+                logger.exception("Exception downloading media: %s", ex)
+                resp.message("Network error when downloading file. Please try again.")
+                return str(resp)
+            except MediaTooLargeError as ex:
+                logger.warning("Rejected media %s: %s", i, ex)
+                resp.message(f"That file is too large. Please send PDFs under {MAX_PDF_BYTES // (1024 * 1024)} MB.")
+                return str(resp)
+            except ValueError as ex:
+                logger.warning("Rejected media %s: %s", i, ex)
+                resp.message("That file is not a valid PDF. Please send PDF files only.")
+                return str(resp)
+            except OSError as ex:
+                # e.g. the session expired mid-download and its scratch dir was removed
+                logger.warning("Could not save media %s: %s", i, ex)
+                resp.message("Failed to download attached file. Please try again.")
+                return str(resp)
+            if not tmp_path:
+                resp.message("Failed to download attached file. Please try again.")
+                return str(resp)
+
+            def add_file(s, path=tmp_path):
+                # Concurrent webhooks from one sender all passed the early check on stale
+                # snapshots; only this atomic update sees the real count
+                if len(s["files"]) >= MAX_SESSION_FILES:
+                    return
+                s["files"].append({"path": path, "orig_name": f"file_{len(s['files'])+1}.pdf"})
+                if len(s["files"]) >= 2:
+                    s["state"] = "awaiting_confirm"
+
+            sess = update_session(from_number, add_file)
+            if not any(f["path"] == tmp_path for f in sess["files"]):
+                Path(tmp_path).unlink(missing_ok=True)
+                resp.message("Only two PDFs can be combined; this extra one was ignored.")
+                continue
+            resp.message(f"Received PDF #{len(sess['files'])}.")
 
         if len(sess["files"]) >= 2:
-            sess["state"] = "awaiting_confirm"
             resp.message("Received two PDFs. Reply YES to confirm combine into a single A4 quadrant PDF, or NO to cancel.")
         return str(resp)
 
-    if body_lower in ("yes", "y") and sess.get("state") == "awaiting_confirm" and len(sess["files"]) >= 2:
+    if command == "confirm" and sess.get("state") == "awaiting_confirm" and len(sess["files"]) >= 2:
+        # Take the session out first so a repeated YES cannot queue a second job
+        sess = pop_session(from_number)
+        if sess is None:
+            resp.message("Combining your PDFs — I'll send the result in a moment.")
+            return str(resp)
+        future = combine_pool.submit(combine_session, sess)
+        # Most combines finish well within Twilio's webhook timeout; answer with TwiML
+        # media then and skip the outbound REST call entirely
+        wait_futures([future], timeout=INLINE_COMBINE_SECONDS)
+        if not future.done():
+            # A combine finishing right now runs the callback on this thread; hand the REST
+            # send to the pool so the ack never waits on it
+            future.add_done_callback(
+                lambda f: combine_pool.submit(send_combined_result, from_number, f))
+            resp.message("Combining your PDFs — I'll send the result in a moment.")
+            return str(resp)
         try:
-            with open(sess["files"][0]["path"], "rb") as f1, open(sess["files"][1]["path"], "rb") as f2:
-                b1 = f1.read()
-                b2 = f2.read()
-            pdf_bytes = combine_pdfs_to_quadrant_pdf(b1, b2, dpi=DPI)
-            file_id = uuid.uuid4().hex
-            tmpdir = Path(tempfile.gettempdir())
-            out_path = tmpdir / f"combined_{file_id}.pdf"
-            with open(out_path, "wb") as outf:
-                outf.write(pdf_bytes)
-            file_url = f"{HOST_BASE_URL}/download/{file_id}"
-            sent = send_whatsapp_message(from_number, "Here is your combined PDF:", media_url=file_url)
-            if not sent:
-                tw = MessagingResponse()
-                m = tw.message("Here is your combined PDF (link):")
-                m.media(file_url)
-                for f in sess["files"]:
-                    try:
-                        Path(f["path"]).unlink(missing_ok=True)
-                    except Exception:
-                        pass
-                user_sessions.pop(from_number, None)
-                return str(tw)
-            for f in sess["files"]:
-                try:
-                    Path(f["path"]).unlink(missing_ok=True)
-                except Exception:
-                    pass
-            user_sessions.pop(from_number, None)
-            return str(MessagingResponse())
+            file_url = future.result()
         except Exception as e:
-            logger.exception("Combine/send failed: %s", e)
+            logger.exception("Combine failed: %s", e)
             resp.message(f"Failed to combine PDFs: {e}")
             return str(resp)
+        m = resp.message("Here is your combined PDF:")
+        m.media(file_url)
+        return str(resp)
 
-    if body_lower in ("no", "n") and sess.get("state") == "awaiting_confirm":
-        for f in sess["files"]:
-            try:
-                Path(f["path"]).unlink(missing_ok=True)
-            except Exception:
-                pass
-        user_sessions.pop(from_number, None)
+    if command == "cancel" and sess.get("state") == "awaiting_confirm":
+        sess = pop_session(from_number)
+        if sess is not None:
+            cleanup_session_files(sess)
         resp.message("Cancelled — uploaded files removed. Send PDFs to start again.")
         return str(resp)
 
@@ -296,4 +858,5 @@ def webhook():
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
+    start_background_threads()
     app.run(host="0.0.0.0", port=port, debug=False)
@@ -0,0 +1,27 @@
+"""
+Gunicorn settings for the WhatsApp PDF Quadrant Combiner Bot.
+
+Start with: gunicorn -c gunicorn_conf.py app:app
+
+gthread workers serve many webhooks at once while each one waits on Twilio
+media downloads. Sessions and combined PDFs live in process memory unless
+REDIS_URL is set, so without Redis exactly one worker runs and WEB_CONCURRENCY
+(which some hosts set on their own) is ignored.
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+worker_class = "gthread"
+if os.environ.get("REDIS_URL"):
+    workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+else:
+    # Several processes would each hold their own sessions and PDFs
+    workers = 1
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+timeout = 60
+keepalive = 5
+
+def post_worker_init(worker):
+    # Each worker starts its own background threads once the app is loaded
+    from app import start_background_threads
+    start_background_threads()
@@ -0,0 +1,7 @@
+import os
+
+# app refuses to import without these; tests never reach Twilio
+os.environ.setdefault("TWILIO_ACCOUNT_SID", "ACtest")
+os.environ.setdefault("TWILIO_AUTH_TOKEN", "test")
+os.environ.setdefault("TWILIO_WHATSAPP_FROM", "whatsapp:+10000000000")
+os.environ.setdefault("HOST_BASE_URL", "http://localhost")
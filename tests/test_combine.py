@@ -0,0 +1,78 @@
+import unittest
+from io import BytesIO
+from unittest import mock
+
+import fitz
+from PIL import Image
+
+import app
+
+
+def text_pdf(pages=2, text="page"):
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page(width=595, height=842)
+        page.insert_text((72, 72), f"{text} {i}", fontsize=24)
+    return doc.tobytes()
+
+
+def jpeg_bytes(px):
+    buf = BytesIO()
+    Image.new("RGB", (px, px), (200, 10, 10)).save(buf, "JPEG")
+    return buf.getvalue()
+
+
+def scan_pdf(px):
+    # Each page is one full-page JPEG, like a phone scan
+    doc = fitz.open()
+    jpeg = jpeg_bytes(px)
+    for _ in range(2):
+        page = doc.new_page(width=595, height=842)
+        page.insert_image(page.rect, stream=jpeg)
+    return doc.tobytes()
+
+
+class CombinePathTest(unittest.TestCase):
+    def test_text_pages_stay_vector(self):
+        with mock.patch.object(app, "combine_pdfs_to_quadrant_pdf") as raster:
+            out = app.combine_pdfs(text_pdf(text="one"), text_pdf(text="two"))
+        raster.assert_not_called()
+        doc = fitz.open(stream=out, filetype="pdf")
+        self.assertEqual(doc.page_count, 1)
+        text = doc[0].get_text()
+        for label in ("one 0", "one 1", "two 0", "two 1"):
+            self.assertIn(label, text)
+
+    def test_oversized_images_fall_back_to_raster(self):
+        self.assertIsNone(app.combine_pdfs_vector(scan_pdf(3000), text_pdf()))
+        out = app.combine_pdfs(scan_pdf(3000), text_pdf())
+        doc = fitz.open(stream=out, filetype="pdf")
+        self.assertEqual(doc.page_count, 1)
+        self.assertEqual(doc[0].get_text().strip(), "")
+        self.assertEqual(len(doc[0].get_images()), 4)
+
+    def test_single_page_pdf_is_rejected(self):
+        with self.assertRaises(ValueError):
+            app.combine_pdfs(text_pdf(pages=1), text_pdf())
+        with self.assertRaises(ValueError):
+            app.combine_pdfs_to_quadrant_pdf(text_pdf(pages=1), text_pdf())
+
+
+class ScanPassthroughTest(unittest.TestCase):
+    def test_scanned_page_jpeg_is_reused_as_is(self):
+        jpegs = app.scanned_page_jpegs(scan_pdf(600))
+        self.assertEqual(jpegs, [jpeg_bytes(600)] * 2)
+
+    def test_text_and_oversized_pages_are_not_passed_through(self):
+        self.assertEqual(app.scanned_page_jpegs(text_pdf()), [None, None])
+        self.assertEqual(app.scanned_page_jpegs(scan_pdf(3000)), [None, None])
+
+    def test_raster_output_embeds_scan_unchanged(self):
+        out = app.combine_pdfs_to_quadrant_pdf(scan_pdf(600), text_pdf())
+        doc = fitz.open(stream=out, filetype="pdf")
+        streams = [doc.xref_stream_raw(img[0]) for img in doc[0].get_images(full=True)]
+        self.assertIn(jpeg_bytes(600), streams)
+
+
+if __name__ == "__main__":
+    unittest.main()
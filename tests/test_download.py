@@ -0,0 +1,61 @@
+import os
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import app
+
+
+class TruncatedPDFHandler(BaseHTTPRequestHandler):
+    # Advertises more bytes than it sends, then drops the connection
+    def do_GET(self):
+        body = b"%PDF-1.4\n" + b"0" * 2000
+        self.send_response(200)
+        self.send_header("Content-Type", "application/pdf")
+        self.send_header("Content-Length", str(len(body) * 4))
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+class TruncatedDownloadTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), TruncatedPDFHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_address[1]}/media.pdf"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_truncated_body_raises_connection_error(self):
+        with tempfile.TemporaryDirectory() as dir_path:
+            with self.assertRaises(requests.ConnectionError):
+                app.download_media_to_tempfile(self.url, dir_path)
+            self.assertEqual(os.listdir(dir_path), [])
+
+    def test_webhook_replies_network_error(self):
+        sender = "whatsapp:+19999999999"
+        try:
+            resp = app.app.test_client().post("/webhook", data={
+                "From": sender, "NumMedia": "1",
+                "MediaUrl0": self.url, "MediaContentType0": "application/pdf"})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Network error", resp.data)
+        finally:
+            sess = app.pop_session(sender)
+            if sess:
+                app.cleanup_session_files(sess)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import app
+from tests.test_combine import text_pdf
+
+
+def make_session(*pdfs):
+    scratch = tempfile.mkdtemp(prefix="esbot_")
+    files = []
+    for i, data in enumerate(pdfs):
+        path = os.path.join(scratch, f"{i}.pdf")
+        with open(path, "wb") as f:
+            f.write(data)
+        files.append({"path": path, "orig_name": f"file_{i + 1}.pdf"})
+    return {"files": files, "state": "awaiting_confirm", "dir": scratch}
+
+
+class FakeClientError(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code}}
+
+
+class DedupeTest(unittest.TestCase):
+    def setUp(self):
+        app.generated_pdfs.clear()
+
+    def test_same_inputs_reuse_the_combined_pdf(self):
+        pdf1, pdf2 = text_pdf(text="one"), text_pdf(text="two")
+        with mock.patch.object(app, "combine_pdfs", wraps=app.combine_pdfs) as combine:
+            first = app.combine_session(make_session(pdf1, pdf2))
+            second = app.combine_session(make_session(pdf1, pdf2))
+            swapped = app.combine_session(make_session(pdf2, pdf1))
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, swapped)
+        self.assertEqual(combine.call_count, 2)
+
+    def test_combine_session_removes_uploads(self):
+        sess = make_session(text_pdf(), text_pdf())
+        app.combine_session(sess)
+        self.assertFalse(os.path.exists(sess["dir"]))
+
+    def test_layout_change_changes_the_key(self):
+        sess = make_session(text_pdf(), text_pdf())
+        self.addCleanup(app.cleanup_session_files, sess)
+        paths = [f["path"] for f in sess["files"]]
+        digest = app.inputs_digest(paths)
+        with mock.patch.object(app, "COMBINE_SALT", app.COMBINE_SALT + b"!"):
+            self.assertNotEqual(app.inputs_digest(paths), digest)
+
+    def test_expired_pdf_is_not_reused(self):
+        app.generated_pdfs["gone"] = (0.0, b"%PDF-old")
+        self.assertIsNone(app.find_generated_pdf("gone"))
+
+
+class S3ReuseTest(unittest.TestCase):
+    def setUp(self):
+        app.generated_pdfs.clear()
+        self.s3 = mock.Mock()
+        self.s3.generate_presigned_url.return_value = "https://s3.example/pdf"
+        for patcher in (mock.patch.object(app, "s3_client", self.s3),
+                        mock.patch.object(app, "S3_BUCKET", "bucket"),
+                        mock.patch.object(app, "ClientError", FakeClientError, create=True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_hit_renews_the_object(self):
+        self.assertEqual(app.find_generated_pdf("abc"), "https://s3.example/pdf")
+        kwargs = self.s3.copy_object.call_args.kwargs
+        self.assertEqual(kwargs["CopySource"], {"Bucket": "bucket", "Key": "combined/abc.pdf"})
+        self.assertEqual(kwargs["MetadataDirective"], "REPLACE")
+
+    def test_missing_object_is_a_quiet_miss(self):
+        self.s3.copy_object.side_effect = FakeClientError("NoSuchKey")
+        with self.assertNoLogs(app.logger, level="WARNING"):
+            self.assertIsNone(app.find_generated_pdf("abc"))
+
+    def test_other_s3_errors_are_logged(self):
+        self.s3.copy_object.side_effect = FakeClientError("AccessDenied")
+        with self.assertLogs(app.logger, level="WARNING"):
+            self.assertIsNone(app.find_generated_pdf("abc"))
+
+
+class DownloadRouteTest(unittest.TestCase):
+    file_id = "0123456789abcdef"
+    pdf = b"%PDF-1.4 " + b"x" * 100
+
+    def setUp(self):
+        app.store_generated_pdf(self.file_id, self.pdf)
+        self.addCleanup(app.generated_pdfs.pop, self.file_id, None)
+        self.client = app.app.test_client()
+
+    def test_download(self):
+        resp = self.client.get(f"/download/{self.file_id}")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, self.pdf)
+        self.assertEqual(resp.mimetype, "application/pdf")
+
+    def test_etag_revalidation(self):
+        resp = self.client.get(f"/download/{self.file_id}",
+                               headers={"If-None-Match": f'"{self.file_id}"'})
+        self.assertEqual(resp.status_code, 304)
+
+    def test_range_request(self):
+        resp = self.client.get(f"/download/{self.file_id}", headers={"Range": "bytes=0-8"})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.data, self.pdf[:9])
+
+    def test_unknown_file(self):
+        self.assertEqual(self.client.get("/download/missing").status_code, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import app
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+class SessionCacheTest(unittest.TestCase):
+    def test_expired_session_files_are_removed(self):
+        now = [0.0]
+        cache = app.SessionCache(maxsize=10, ttl=60, timer=lambda: now[0])
+        scratch = tempfile.mkdtemp(prefix="esbot_")
+        cache["whatsapp:+1"] = {"files": [], "state": "collecting", "dir": scratch}
+        now[0] = 61
+        cache.expire()
+        self.assertNotIn("whatsapp:+1", cache)
+        self.assertFalse(os.path.exists(scratch))
+
+    def test_evicted_session_files_are_removed(self):
+        cache = app.SessionCache(maxsize=1, ttl=60)
+        first, second = tempfile.mkdtemp(prefix="esbot_"), tempfile.mkdtemp(prefix="esbot_")
+        self.addCleanup(app.cleanup_session_files, {"dir": second})
+        cache["whatsapp:+1"] = {"files": [], "dir": first}
+        cache["whatsapp:+2"] = {"files": [], "dir": second}
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(second))
+
+
+def fake_download(m_url, dir_path):
+    # Slow enough that concurrent webhooks all pass the early cap check
+    time.sleep(0.1)
+    fd, path = tempfile.mkstemp(dir=dir_path, suffix=".pdf")
+    with os.fdopen(fd, "wb") as f:
+        f.write(b"%PDF-1.4 test")
+    return path
+
+
+class FileCapTest(unittest.TestCase):
+    sender = "whatsapp:+15550000001"
+
+    def tearDown(self):
+        self.clear_session()
+
+    def clear_session(self):
+        sess = app.pop_session(self.sender)
+        if sess:
+            app.cleanup_session_files(sess)
+
+    def post_pdf(self, _):
+        return app.app.test_client().post("/webhook", data={
+            "From": self.sender, "NumMedia": "1",
+            "MediaUrl0": "https://api.twilio.com/media", "MediaContentType0": "application/pdf",
+        }).data.decode()
+
+    def upload_concurrently(self, count):
+        with mock.patch.object(app, "download_media_to_tempfile", fake_download):
+            # The first upload creates the scratch dir the concurrent ones share
+            replies = [self.post_pdf(0)]
+            with ThreadPoolExecutor(max_workers=count) as pool:
+                replies += list(pool.map(self.post_pdf, range(count)))
+        return replies
+
+    def assert_capped(self, replies):
+        sess = app.get_session(self.sender)
+        self.assertEqual(len(sess["files"]), app.MAX_SESSION_FILES)
+        self.assertEqual(len(os.listdir(sess["dir"])), app.MAX_SESSION_FILES)
+        accepted = sum("Received PDF #" in reply for reply in replies)
+        self.assertEqual(accepted, app.MAX_SESSION_FILES)
+
+    def test_concurrent_uploads_respect_cap(self):
+        self.assert_capped(self.upload_concurrently(6))
+
+    @unittest.skipUnless(fakeredis, "fakeredis not installed")
+    def test_concurrent_uploads_respect_cap_with_redis(self):
+        with mock.patch.object(app, "redis_client", fakeredis.FakeRedis()):
+            replies = self.upload_concurrently(6)
+            self.assert_capped(replies)
+            self.clear_session()
+
+    def test_non_pdf_media_leaves_no_session(self):
+        resp = app.app.test_client().post("/webhook", data={
+            "From": self.sender, "NumMedia": "1",
+            "MediaUrl0": "https://api.twilio.com/media", "MediaContentType0": "video/mp4",
+        })
+        self.assertIn(b"PDF files only", resp.data)
+        self.assertIsNone(app.pop_session(self.sender))
+
+
+if __name__ == "__main__":
+    unittest.main()